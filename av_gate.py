@@ -1,21 +1,39 @@
+import base64
+import binascii
 import configparser
-import email.generator
-import email.parser
-import email.policy
+import copy
+import functools
+import http.cookiejar
 import io
 import logging
 import os
 import re
 import socket
+import threading
 import types
 import ssl
-from email.message import EmailMessage
-from typing import List, cast
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import (
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+    cast,
+)
 from urllib.parse import unquote, urlparse
+from xml.sax.saxutils import escape
 
 import lxml.etree as ET
 import requests
 import urllib3
+from requests.adapters import HTTPAdapter
 from flask import Flask, Response, abort, request, stream_with_context
 
 __version__ = "1.6"
@@ -51,6 +69,151 @@ CONTENT_MAX = config["config"].getint("content_max", 800)
 REMOVE_MALICIOUS = config["config"].getboolean("remove_malicious", False)
 ALL_PNG_MALICIOUS = config["config"].getboolean("all_png_malicious", False)
 ALL_PDF_MALICIOUS = config["config"].getboolean("all_pdf_malicious", False)
+POOL_MAXSIZE = config["config"].getint("pool_maxsize", 32)
+
+# attachments are scanned concurrently, threads are started on first use
+SCAN_POOL = ThreadPoolExecutor(max_workers=config["config"].getint("scan_workers", 8))
+
+PNG_MAGIC = bytes.fromhex("89504E470D0A1A0A")
+PDF_MAGIC = bytes.fromhex("25504446")
+EICAR = b"$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!$H+H*"
+
+CHUNK_SIZE = 64 * 1024
+
+# lower case names, hop-by-hop headers (RFC 9110 7.6.1) belong to the connection of
+# the client, on the pooled konnektor connection they would close or desync it
+SKIP_REQUEST_HEADERS = frozenset(
+    {
+        "x-real-ip",
+        "host",
+        "connection",
+        "keep-alive",
+        "proxy-connection",
+        "proxy-authenticate",
+        "proxy-authorization",
+        "te",
+        "trailer",
+        "transfer-encoding",
+        "upgrade",
+    }
+)
+SKIP_RESPONSE_HEADERS = frozenset(
+    {
+        "content-length",
+        "connection",
+        "date",
+        "transfer-encoding",
+        "mimetype",
+        "content-type",
+    }
+)
+KONNEKTOR_CHECK_MAX = 64 * 1024
+
+RE_CLAMD_RESULT = re.compile(rb"stream: (?:(.+) )?(FOUND|OK|ERROR)")
+RE_EICAR = re.compile(re.escape(EICAR))
+RE_BOUNDARY = re.compile(r'boundary="([^"]+)"', re.I)
+RE_ICAP_NULL_BODY = re.compile(rb"Encapsulated:[^\r\n]*null-body=(\d+)", re.I)
+RE_ICAP_INFECTION = re.compile(rb"X-Infection-Found: .*Threat=(.*);")
+RE_PHR_SERVICE = re.compile(
+    rb"<(?:[\w.-]+:)?Service\s[^>]*Name=[\"']PHRService[\"']"
+    rb".*?</(?:[\w.-]+:)?Service>",
+    re.S,
+)
+RE_ENDPOINT_TLS = re.compile(
+    rb"(<(?:[\w.-]+:)?EndpointTLS\s[^>]*Location=[\"'])([^\"']*)"
+)
+
+
+@dataclass(frozen=True)
+class ClientConfig:
+    """Settings of a Konnektor section in av_gate.ini"""
+
+    name: str
+    konnektor: str
+    konnektor_bytes: bytes
+    cert: Optional[Tuple[str, str]]
+    verify: bool
+    proxy_all_services: bool
+
+
+def load_clients() -> Dict[str, ClientConfig]:
+    """Read Konnektor sections once instead of using configparser per request"""
+    clients = {}
+    for client in config.sections():
+        if client == "config":
+            continue
+        section = config[client]
+
+        # client cert
+        cert = None
+        if section.get("ssl_cert"):
+            cert = (section["ssl_cert"], section["ssl_key"])
+
+        clients[client] = ClientConfig(
+            name=client,
+            konnektor=section["konnektor"],
+            konnektor_bytes=section["konnektor"].encode("ascii"),
+            cert=cert,
+            # requests verifies unless told otherwise, None would turn it off
+            verify=section.getboolean("ssl_verify", True),
+            proxy_all_services=section.getboolean("proxy_all_services", False),
+        )
+    resolve_client.cache_clear()
+    return clients
+
+
+@functools.lru_cache(maxsize=1024)
+def resolve_client(request_ip: str, host: str) -> Optional[str]:
+    """Returns section for client ip and target port, the set of clients is small"""
+    port = host.split(":")[1] if ":" in host else "443"
+
+    client = f"{request_ip}:{port}"
+    if client in CLIENTS:
+        return client
+
+    fallback = "*:" + port
+    if fallback in CLIENTS:
+        return fallback
+
+    return None
+
+
+CLIENTS = load_clients()
+
+# one session (connection pool) per konnektor, created lazily in each worker
+SESSIONS: Dict[str, requests.Session] = {}
+
+
+def compile_xpath(path: str) -> ET.XPath:
+    """Compile path with namespace wildcards like {*}Body to XPath"""
+    return ET.XPath(re.sub(r"\{\*\}(\w+)", r"*[local-name()='\1']", path))
+
+
+xml_local = threading.local()
+
+
+def get_xml_parser() -> ET.XMLParser:
+    "return configured parser of current thread, lxml parsers are not shared"
+    if not hasattr(xml_local, "parser"):
+        # no DTD entities and no id index needed, SOAP parts can be large
+        xml_local.parser = ET.XMLParser(
+            resolve_entities=False, collect_ids=False, huge_tree=True
+        )
+    return xml_local.parser
+
+
+# a compiled local-name() XPath only beats find/findall for these two, the other
+# paths stay with lxml's own {*} lookups
+XPATH_RETRIEVE_RESP = compile_xpath("{*}Body/{*}RetrieveDocumentSetResponse")
+XPATH_INCLUDE = compile_xpath("{*}Document/{*}Include")
+
+PATH_ENDPOINT_TLS = "{*}ServiceInformation/{*}Service//{*}EndpointTLS"
+PATH_PHR_TLS = "{*}ServiceInformation/{*}Service[@Name='PHRService']//{*}EndpointTLS"
+PATH_REGISTRY_RESP = "{*}RegistryResponse"
+PATH_ERRLIST = "{*}RegistryErrorList"
+PATH_DOCUMENT_RESP = "{*}DocumentResponse"
+PATH_UNIQUE_ID = "{*}DocumentUniqueId"
+PATH_MIMETYPE = "{*}mimeType"
 
 
 @app.route("/connector.sds", methods=["GET"])
@@ -60,19 +223,25 @@ def connector_sds():
     # <si:EndpointTLS Location="https://kon-instanz1.titus.ti-dienste.de:443/soap-api/PHRService/1.3.0"/>
 
     client_config = get_client_config()
-    with request_upstream(client_config, warn=False) as upstream:
-        xml = ET.fromstring(upstream.content)
+    with request_upstream(client_config) as upstream:
+        if not client_config.proxy_all_services:
+            # only one service changes, so skip parsing and serializing the xml
+            content, count = RE_PHR_SERVICE.subn(
+                replace_phr_locations, upstream.content
+            )
+            if count:
+                return create_response(content, upstream)
 
-        if client_config.getboolean("proxy_all_services", False):
-            for e in xml.findall("{*}ServiceInformation/{*}Service//{*}EndpointTLS"):
+        xml = ET.fromstring(upstream.content, get_xml_parser())
+
+        if client_config.proxy_all_services:
+            for e in xml.findall(PATH_ENDPOINT_TLS):
                 previous_url = urlparse(e.attrib["Location"])
                 e.attrib[
                     "Location"
                 ] = f"{previous_url.scheme}://{request.host}{previous_url.path}"
 
-        for e in xml.findall(
-            "{*}ServiceInformation/{*}Service[@Name='PHRService']//{*}EndpointTLS"
-        ):
+        for e in xml.findall(PATH_PHR_TLS):
             previous_url = urlparse(e.attrib["Location"])
             e.attrib[
                 "Location"
@@ -83,6 +252,21 @@ def connector_sds():
         return create_response(ET.tostring(xml), upstream)
 
 
+def replace_phr_locations(service: re.Match) -> bytes:
+    """replace the endpoints within the raw PHRService element"""
+
+    # scheme and path are taken over already escaped, only the host is new
+    host = escape(request.host, {'"': "&quot;", "'": "&apos;"})
+
+    def replace_location(location: re.Match) -> bytes:
+        previous_url = urlparse(location[2].decode())
+        return location[1] + (
+            f"{previous_url.scheme}://{host}{previous_url.path}"
+        ).encode("ascii", "xmlcharrefreplace")
+
+    return RE_ENDPOINT_TLS.sub(replace_location, service[0])
+
+
 @app.route("/<path:path>", methods=ALL_METHODS)
 def switch(path):
     """Entrypoint with filter for PHRService"""
@@ -109,24 +293,15 @@ def check():
     """Health check for Konnektors"""
     res = ""
     err_count = 0
-    for client in config.sections():
-        if client == "config":
-            continue
-        client_config = config[client]
-        konn = client_config["konnektor"]
-
-        # client cert
-        cert = None
-        if client_config.get("ssl_cert"):
-            cert = (client_config["ssl_cert"], client_config["ssl_key"])
-        verify = client_config.getboolean("ssl_verify")
+    for client, client_config in CLIENTS.items():
+        konn = client_config.konnektor
 
         try:
-            test = requests.request(
+            test = get_session(client_config).request(
                 method=request.method,
                 url=konn + "/connector.sds",
-                cert=cert,
-                verify=verify,
+                cert=client_config.cert,
+                verify=client_config.verify,
                 timeout=3
             )
 
@@ -148,7 +323,8 @@ def check():
 def check_clamav():
     clamd_path = config["config"].get("clamd_socket")
     if clamd_path:
-        test = clamav_sock.ping()
+        import clamd  # type: ignore
+        test = clamd.ClamdUnixSocket(path=clamd_path).ping()
         if  test != "PONG":
             logging.warn(f"Healtchckeck failed for clamav: {test}")
             return "clamav: no ping\n"
@@ -165,16 +341,16 @@ def check_icap():
 def phr_service(path):
     """Scan AV on xop documents for retrieveDocumentSetRequest"""
     client_config = get_client_config()
-    with request_upstream(client_config) as upstream:
-        data = run_antivirus(upstream)
+    with request_upstream(client_config, stream=True) as upstream:
+        content = read_content(upstream)
+        warn_konnektor_address(client_config, content)
+        data = run_antivirus(upstream, content)
 
         if not data:
             logging.info("no new body, copying content from konnektor")
-            data = upstream.content
+            data = content
 
-        assert (
-            b"$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!$H+H*" not in data
-        ), "found EICAR signature"
+        assert EICAR not in data, "found EICAR signature"
 
         response = create_response(data, upstream)
 
@@ -184,52 +360,56 @@ def phr_service(path):
 def other(path):
     """Streamed forward without scan"""
     client_config = get_client_config()
-    upstream = request_upstream(client_config, stream=True)
+    upstream = request_upstream(client_config, stream=True, stream_request=True)
 
     def generate():
-        for data in upstream.iter_content():
-            yield data
-        upstream.close()
+        # pass bytes on as received, Content-Encoding is forwarded unchanged
+        try:
+            for data in upstream.raw.stream(CHUNK_SIZE, decode_content=False):
+                yield data
+        finally:
+            upstream.close()
 
     response = create_response(generate, upstream)
     return response
 
 
-def request_upstream(client_config, warn=True, stream=False):
+def request_upstream(client_config: ClientConfig, stream=False, stream_request=False):
     """Request to real Konnektor"""
 
-    konn = client_config["Konnektor"]
+    konn = client_config.konnektor
     url = konn + request.path
-    data = request.get_data()
 
-    # client cert
-    cert = None
-    if client_config.get("ssl_cert"):
-        cert = (client_config["ssl_cert"], client_config["ssl_key"])
-    verify = client_config.getboolean("ssl_verify")
+    data: Union[bytes, RequestBody]
+    if stream_request and request.content_length:
+        # request body is not inspected, pass it on without reading it first
+        data = RequestBody(request.stream, request.content_length)
+    else:
+        data = request.get_data()
 
+    # headers named in Connection are hop-by-hop as well
+    connection = request.headers.get("Connection", "")
+    skip_headers = SKIP_REQUEST_HEADERS.union(
+        name.strip().lower() for name in connection.split(",")
+    )
     headers = {
         key: value
         for key, value in request.headers.items()
-        if key not in ("X-Real-Ip", "Host")
+        if key.lower() not in skip_headers
     }
 
     try:
-        response = requests.request(
+        response = get_session(client_config).request(
             method=request.method,
             url=url,
             headers=headers,
             data=data,
-            cert=cert,
-            verify=verify,
+            # per request, Session.verify would lose against REQUESTS_CA_BUNDLE
+            cert=client_config.cert,
+            verify=client_config.verify,
             stream=stream,
         )
 
-        if warn and not stream and bytes(konn, "ascii") in response.content:
-            logging.warning(
-                f"Found Konnektor Address in response: {konn} - {request.path}"
-            )
-
         return response
 
     except Exception as err:
@@ -237,22 +417,83 @@ def request_upstream(client_config, warn=True, stream=False):
         abort(502)
 
 
-def get_client_config():
+class RequestBody:
+    """Incoming request body read in chunks, len() keeps Content-Length
+
+    requests would send a plain generator with Transfer-Encoding: chunked.
+    """
+
+    def __init__(self, stream, length: int):
+        self.stream = stream
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(functools.partial(self.stream.read, CHUNK_SIZE), b"")
+
+
+def read_content(upstream: requests.Response) -> bytearray:
+    """Reads streamed body into one growing buffer
+
+    requests would keep the list of chunks and their joined copy at once.
+    """
+    content = bytearray()
+    try:
+        for chunk in upstream.iter_content(CHUNK_SIZE):
+            content += chunk
+    except Exception as err:
+        # connection to the konnektor broke off while receiving the body
+        logging.error(err)
+        abort(502)
+    return content
+
+
+def warn_konnektor_address(client_config: ClientConfig, content) -> None:
+    """Logs a warning if the response points clients to the konnektor directly"""
+    # addresses are in connector.sds or the SOAP part in front of the documents,
+    # so only the head of the response is searched
+    if (
+        logging.getLogger().isEnabledFor(logging.WARNING)
+        and content.find(client_config.konnektor_bytes, 0, KONNEKTOR_CHECK_MAX) >= 0
+    ):
+        logging.warning(
+            f"Found Konnektor Address in response: "
+            f"{client_config.konnektor} - {request.path}"
+        )
+
+
+def get_session(client_config: ClientConfig) -> requests.Session:
+    """Returns pooled session for konnektor, keeps TCP/TLS connections alive"""
+    session = SESSIONS.get(client_config.name)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_MAXSIZE, pool_maxsize=POOL_MAXSIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        # shared by all clients of the konnektor, so no cookies are kept
+        session.cookies.set_policy(
+            http.cookiejar.DefaultCookiePolicy(allowed_domains=[])
+        )
+
+        # another thread of the worker may have been faster
+        session = SESSIONS.setdefault(client_config.name, session)
+    return session
+
+
+def get_client_config() -> ClientConfig:
     request_ip = request.headers["X-real-ip"]
-    port = request.host.split(":")[1] if ":" in request.host else "443"
+    host = request.host
+    client = resolve_client(request_ip, host)
+    logging.debug(f"client {request_ip} {host}: {client}")
 
-    client = f"{request_ip}:{port}"
-    logging.debug(f"client {client}")
+    if client is None:
+        logging.error(f"Client {request_ip} {host} not found in av_gate.ini")
+        abort(503)
 
-    if config.has_section(client):
-        return config[client]
-    else:
-        fallback = "*:" + port
-        if not config.has_section(fallback):
-            logging.error(f"Client {client} not found in av_gate.ini")
-            abort(503)
-        else:
-            return config[fallback]
+    return CLIENTS[client]
 
 
 def create_response(data, upstream: Response) -> Response:
@@ -260,15 +501,7 @@ def create_response(data, upstream: Response) -> Response:
     headers = {
         k: v
         for (k, v) in upstream.headers.items()
-        if k
-        not in (
-            "Content-Length",
-            "Connection",
-            "Date",
-            "Transfer-Encoding",
-            "Mimetype",
-            "Content-Type",
-        )
+        if k.lower() not in SKIP_RESPONSE_HEADERS
     }
 
     if type(data) is types.FunctionType:
@@ -280,6 +513,17 @@ def create_response(data, upstream: Response) -> Response:
             content_type=upstream.headers.get("Content-Type"),
             direct_passthrough=True,
         )
+    elif not isinstance(data, bytes):
+        # WSGI servers only take bytes, pass buffers on in slices, not one copy
+        headers["Content-Length"] = str(len(data))
+        response = Response(
+            iter_chunks(data),
+            status=upstream.status_code,
+            headers=headers,
+            mimetype=upstream.headers.get("Mimetype"),
+            content_type=upstream.headers.get("Content-Type"),
+            direct_passthrough=True,
+        )
     else:
         response = Response(
             response=data,
@@ -293,246 +537,362 @@ def create_response(data, upstream: Response) -> Response:
     return response
 
 
-def run_antivirus(res: requests.Response):
+def iter_chunks(data) -> Iterator[bytes]:
+    """Yields buffer as bytes of CHUNK_SIZE"""
+    view = memoryview(data)
+    for pos in range(0, len(view), CHUNK_SIZE):
+        yield bytes(view[pos : pos + CHUNK_SIZE])
+
+
+class MimePart(NamedTuple):
+    """Part of a multipart body, raw is kept for passing it on untouched"""
+
+    raw: memoryview
+    headers: Dict[str, str]
+    body: memoryview
+    content_id: Optional[str]
+
+
+def iter_mime_parts(content: bytes, boundary: bytes) -> Iterator[MimePart]:
+    """Split multipart content at boundary without building an EmailMessage
+
+    raw and body are memoryview slices of content, so no part gets copied.
+    raw starts with the delimiter in front of the part, joining all raw slices
+    gives content again.
+    """
+    view = memoryview(content)
+    start = head_start = 0
+    # without preamble the first delimiter may come without leading CRLF
+    if content.startswith(boundary[2:]):
+        head_start = len(boundary) - 2
+
+    while True:
+        end = content.find(boundary, head_start)
+        if end < 0:
+            end = len(content)
+
+        headers: Dict[str, str] = {}
+        head_end = content.find(b"\r\n\r\n", head_start, end)
+        if head_end >= 0:
+            for line in content[head_start:head_end].split(b"\r\n"):
+                key, colon, value = line.partition(b":")
+                if colon:
+                    headers[key.strip().decode("latin-1").lower()] = (
+                        value.strip().decode("latin-1")
+                    )
+            body = view[head_end + 4 : end]
+        else:
+            # preamble or closing delimiter
+            body = view[end:end]
+
+        content_id = headers.get("content-id")
+        yield MimePart(
+            view[start:end],
+            headers,
+            body,
+            extract_id(content_id) if content_id else None,
+        )
+
+        if end == len(content):
+            break
+        start, head_start = end, end + len(boundary)
+
+
+def get_content(part: MimePart) -> Union[bytes, memoryview]:
+    """Returns decoded body of part"""
+    encoding = part.headers.get("content-transfer-encoding", "").lower()
+    if encoding == "base64":
+        return base64.b64decode(part.body)
+    if encoding == "quoted-printable":
+        return binascii.a2b_qp(part.body)
+    return part.body
+
+
+def xpath_first(xpath: ET.XPath, element):
+    """Returns first element found by compiled xpath or None"""
+    found = cast(list, xpath(element))
+    return found[0] if found else None
+
+
+def parse_documents(soap: Union[bytes, memoryview]):
+    """Returns content_id -> (document_id, mimetype) of RetrieveDocumentSetResponse
+
+    Parses incrementally and drops every DocumentResponse once read, so memory
+    stays flat for large SOAP parts. Returns None for other responses.
+    """
+    documents = {}
+    found = False
+
+    for _, elem in ET.iterparse(
+        io.BytesIO(soap),
+        tag=("{*}RetrieveDocumentSetResponse", "{*}DocumentResponse"),
+        # same options as get_xml_parser, tree is only read and never serialized
+        remove_blank_text=True,
+        resolve_entities=False,
+        collect_ids=False,
+        huge_tree=True,
+    ):
+        if ET.QName(elem).localname == "RetrieveDocumentSetResponse":
+            found = True
+            continue
+
+        # inline documents come without xop:Include and have no attachment
+        include = xpath_first(XPATH_INCLUDE, elem)
+        href = include.get("href") if include is not None else None
+        if href:
+            unique_id_xml = elem.find(PATH_UNIQUE_ID)
+            mimetype_xml = elem.find(PATH_MIMETYPE)
+            documents[extract_id(href)] = (
+                unique_id_xml.text if unique_id_xml is not None else None,
+                mimetype_xml.text if mimetype_xml is not None else None,
+            )
+
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+    if found:
+        logging.debug(f"content_ids: {list(documents.keys())}")
+        return documents
+
+
+def run_antivirus(res: requests.Response, content: bytes):
     """Remove document when virus was found"""
 
     # only interested in multipart
-    if not res.headers["Content-Type"].lower().startswith("multipart"):
+    content_type = res.headers["Content-Type"]
+    if not content_type.lower().startswith("multipart"):
         return
 
-    # add Header for content-type
-    body = (
-        bytes(f"Content-Type: {res.headers['Content-Type']}\r\n\r\n\r\n", "ascii")
-        + res.content
-    )
-    msg = cast(
-        EmailMessage,
-        email.parser.BytesParser(policy=email.policy.default).parsebytes(body),
-    )
-    soap_part = cast(EmailMessage, next(msg.iter_parts()))
-    xml = ET.fromstring(soap_part.get_payload())
-    response_xml = xml.find("{*}Body/{*}RetrieveDocumentSetResponse")
+    # only interested in RetrieveDocumentSet, skip everything else unparsed
+    if content.find(b"RetrieveDocumentSetResponse") < 0:
+        return
+
+    m = RE_BOUNDARY.search(content_type)
+    assert m
+    boundary = b"\r\n--" + bytes(m[1], "ascii")
 
-    # only interested in RetrieveDocumentSet
-    if response_xml is None:
-        logging.info(f"XML NOT FOUND RetrieveDocument {soap_part.get_payload()[:200]}")
+    # preamble and closing delimiter come without headers
+    parts = list(iter_mime_parts(content, boundary))
+    soap_part, *attachments = [part for part in parts if part.headers]
+    documents = parse_documents(soap_part.body)
+
+    if documents is None:
+        logging.info(
+            f"XML NOT FOUND RetrieveDocument {bytes(soap_part.body[:200])!r}"
+        )
         return
 
-    virus_atts = list(get_malicious_content_ids(msg))
+    # one search over the whole body, base64 parts are still checked decoded
+    has_eicar = content.find(EICAR) >= 0
+    virus_atts = set(get_malicious_content_ids(attachments, has_eicar))
 
     if virus_atts:
-        xml_resp = response_xml.find("{*}RegistryResponse")
-        assert xml_resp is not None
-        m = re.search("{.*}", xml_resp.tag)
-        assert m
-        xml_ns = m[0]
-
-        # ger errlist
-        xml_errlist = xml_resp.find("{*}RegistryErrorList")
-        if not xml_errlist:
-            xml_errlist = ET.Element(f"{xml_ns}RegistryErrorList")
-            xml_resp.append(xml_errlist)
-
-        xml_documents = {}
-
-        for doc in response_xml.findall("{*}DocumentResponse"):
-            include = doc.find("{*}Document/{*}Include")
-            assert include is not None
-            href = cast(str, include.attrib["href"])
-            assert href
-            content_id = extract_id(href)
-            xml_documents[content_id] = doc
-
-        logging.debug(f"content_ids: {list(xml_documents.keys())}")
-
-        attachments = cast(List[EmailMessage], list(msg.iter_attachments()))
-        msg.set_payload([soap_part])
+        # new body per content_id, None for removed documents
+        bodies: Dict[Optional[str], Optional[Union[bytes, memoryview]]] = {}
         for att in attachments:
-            handle_attachment(
-                msg, response_xml, virus_atts, xml_ns, xml_errlist, xml_documents, att
+            bodies[att.content_id] = handle_attachment(
+                virus_atts, documents, att
             )
 
         if REMOVE_MALICIOUS:
-            fix_status(xml_resp, xml_errlist, xml_ns, msg)
-
-    if virus_atts:
-        if REMOVE_MALICIOUS:
-            soap_part.set_payload(ET.tostring(xml), charset="utf-8")
-            del soap_part["MIME-Version"]
+            # only here the SOAP part has to be parsed and serialized completely
+            bodies[soap_part.content_id] = remove_documents(
+                bytes(soap_part.body),
+                {cid for cid, body in bodies.items() if body is None},
+                any(body is not None for body in bodies.values()),
+            )
 
-        payload = build_payload(msg, virus_atts, res)
+        payload = build_payload(parts, bodies)
 
         return payload
 
 
+def remove_documents(
+    soap: bytes, removed: Set[Optional[str]], has_documents: bool
+) -> bytes:
+    """Removes document references from SOAP response and adds error messages"""
+    xml = ET.fromstring(soap, get_xml_parser())
+    response_xml = xpath_first(XPATH_RETRIEVE_RESP, xml)
+    assert response_xml is not None
+    xml_resp = response_xml.find(PATH_REGISTRY_RESP)
+    assert xml_resp is not None
+    xml_ns = xml_resp.tag[: xml_resp.tag.index("}") + 1]
+
+    # ger errlist
+    xml_errlist = xml_resp.find(PATH_ERRLIST)
+    if not xml_errlist:
+        xml_errlist = ET.Element(f"{xml_ns}RegistryErrorList")
+        xml_resp.append(xml_errlist)
+
+    for doc in response_xml.findall(PATH_DOCUMENT_RESP):
+        include = xpath_first(XPATH_INCLUDE, doc)
+        if include is not None and extract_id(include.get("href", "")) in removed:
+            unique_id_xml = doc.find(PATH_UNIQUE_ID)
+            assert unique_id_xml is not None
+            add_error_msg(unique_id_xml.text, xml_errlist, xml_ns)
+            response_xml.remove(doc)
+
+    fix_status(xml_resp, xml_errlist, xml_ns, has_documents)
+
+    return ET.tostring(xml)
+
+
 def handle_attachment(
-    msg, response_xml, virus_atts, xml_ns, xml_errlist, xml_documents, att
-):
-    """removes or replaces malicious attachment"""
-    content_id = extract_id(att["Content-ID"])
-    document_xml = xml_documents[content_id]
-    unique_id_xml = document_xml.find("{*}DocumentUniqueId")
-    assert unique_id_xml is not None
-    document_id = unique_id_xml.text
-    mimetype_xml = document_xml.find("{*}mimeType")
-    assert mimetype_xml is not None
-    mimetype = mimetype_xml.text
+    virus_atts, documents, att: MimePart
+) -> Optional[Union[bytes, memoryview]]:
+    """removes or replaces malicious attachment, returns None for removed"""
+    content_id = att.content_id
+    assert content_id in documents, f"no DocumentResponse for {content_id!r}"
+    document_id, mimetype = documents[content_id]
 
     if content_id in virus_atts:
         if REMOVE_MALICIOUS:
-            add_error_msg(document_xml, xml_errlist, xml_ns)
-            # remove document reference
-            response_xml.remove(document_xml)
             logging.info(f"document removed {content_id!r} {document_id!r}")
+            return None
 
         else:
             # replace document
             logging.info(
                 f"document replaced {content_id!r} {document_id!r} {mimetype!r}"
             )
-            att.set_payload(get_replacement(mimetype))
-            msg.attach(att)
+            replacement = get_replacement(mimetype)
+            encoding = att.headers.get("content-transfer-encoding", "").lower()
+            if encoding == "base64":
+                replacement = base64.encodebytes(replacement)
+            elif encoding == "quoted-printable":
+                replacement = binascii.b2a_qp(replacement)
+            return replacement
     else:
         logging.debug(f"document untouched {content_id!r} {document_id!r}")
-        msg.attach(att)
+        return att.body
 
 
-def get_malicious_content_ids(msg):
+def get_malicious_content_ids(attachments: List[MimePart], has_eicar: bool = True):
     """Extracting content_ids of malicious attachments"""
-    for att in msg.iter_attachments():
-        scan_res = scan_file(att.get_content())
-        content_id = extract_id(att["Content-ID"])
-
-        test_malicous = False
-        if ALL_PNG_MALICIOUS and att.get_content().startswith(
-            bytearray.fromhex("89504E470D0A1A0A")
-        ):
-            test_malicous = True
-        if ALL_PDF_MALICIOUS and att.get_content().startswith(
-            bytearray.fromhex("25504446")
-        ):
-            test_malicous = True
+    contents = [get_content(att) for att in attachments]
+    scan_results = SCAN_POOL.map(scan_file, contents)
+
+    for att, content, scan_res in zip(attachments, contents, scan_results):
+        content_id = att.content_id
+
+        test_malicous = (
+            ALL_PNG_MALICIOUS and content[: len(PNG_MAGIC)] == PNG_MAGIC
+        ) or (ALL_PDF_MALICIOUS and content[: len(PDF_MAGIC)] == PDF_MAGIC)
 
         if scan_res[0] != "OK" or test_malicous:
             logging.info(f"virus found {content_id} : {scan_res}")
             yield content_id
         else:
             logging.info(f"scanned document {content_id} : {scan_res}")
-            if b"$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!$H+H*" in att.get_content():
+            check_eicar = has_eicar or content is not att.body
+            if check_eicar and RE_EICAR.search(content):
                 logging.error(f"EICAR was not detected by clamav {content_id}")
 
 
+@functools.lru_cache(maxsize=1024)
 def extract_id(id: str) -> str:
     """Returns content_id without prefix and postfix"""
-    id = unquote(id)
+    if "%" in id:
+        id = unquote(id)
 
     if id.startswith("cid:"):
         id = id[4:]
-    if id.startswith("<"):
+    if id.startswith("<") and id.endswith(">"):
         id = id[1:-1]
-    if "@" in id:
-        id = id[: id.index("@")]
+    at = id.find("@")
+
+    return id[:at] if at >= 0 else id
+
+
+# errors are copied from templates, deepcopy is cheaper than building the elements
+# attributes keep the order in which the elements were written before
+ERROR_MALWARE = ET.Element(
+    "RegistryError",
+    {
+        "text": "",
+        "codeContext": "",
+        "errorCode": "XDSDocumentUniqueIdError",  # from RetrieveDocumentSetResponse
+        # "errorCode": "XDSMissingDocument", # from AdHocQueryResponse
+        "severity": "urn:oasis:names:tc:ebxml-regrep:ErrorSeverityType:Error",
+    },
+)
+ERROR_NO_DOCUMENTS = ET.Element(
+    "RegistryError",
+    {
+        "text": "No documents found for unique ids in request",
+        "severity": "urn:oasis:names:tc:ebxml-regrep:ErrorSeverityType:Error",
+        "errorCode": "XDSRegistryMetadataError",
+        "codeContext": "No documents found for unique ids in request",
+    },
+)
+
 
-    return id
+def copy_error(template, xml_ns):
+    """Returns copy of error template in namespace of the response"""
+    xml_error = copy.deepcopy(template)
+    xml_error.tag = f"{xml_ns}RegistryError"
+    return xml_error
 
 
 def add_error_msg(document_id, xml_errlist, xml_ns):
     """Adds error message to SOAP message for given document"""
     err_text = f"Document was detected as malware for uniqueId '{document_id}'."
-    xml_errlist.append(
-        ET.Element(
-            f"{xml_ns}RegistryError",
-            attrib={
-                "codeContext": err_text,
-                "errorCode": "XDSDocumentUniqueIdError",  # from RetrieveDocumentSetResponse
-                # "errorCode": "XDSMissingDocument", # from AdHocQueryResponse
-                "severity": "urn:oasis:names:tc:ebxml-regrep:ErrorSeverityType:Error",
-            },
-            text=err_text,
-        )
-    )
+    xml_error = copy_error(ERROR_MALWARE, xml_ns)
+    xml_error.set("text", err_text)
+    xml_error.set("codeContext", err_text)
+    xml_errlist.append(xml_error)
 
 
-def fix_status(xml_resp, xml_errlist, xml_ns, msg):
+def fix_status(xml_resp, xml_errlist, xml_ns, has_documents):
     """Adds overall error message to SOAP response"""
-    if len(msg.get_payload()) > 1:
+    if has_documents:
         xml_resp.attrib["status"] = "urn:ihe:iti:2007:ResponseStatusType:PartialSuccess"
     else:
         xml_resp.attrib[
             "status"
         ] = "urn:oasis:names:tc:ebxml-regrep:ResponseStatusType:Failure"
-        xml_errlist.append(
-            ET.Element(
-                f"{xml_ns}RegistryError",
-                attrib={
-                    "severity": "urn:oasis:names:tc:ebxml-regrep:ErrorSeverityType:Error",
-                    "errorCode": "XDSRegistryMetadataError",
-                    "codeContext": "No documents found for unique ids in request",
-                },
-                text="No documents found for unique ids in request",
-            )
-        )
+        xml_errlist.append(copy_error(ERROR_NO_DOCUMENTS, xml_ns))
 
 
-def build_payload(msg: EmailMessage, virus_atts: List[str], res: requests.Response):
-    "create payload based on original response with replacing only payoad for virus_atts"
+def build_payload(
+    parts: List[MimePart],
+    bodies: Dict[Optional[str], Optional[Union[bytes, memoryview]]],
+):
+    """create payload based on original parts with replacing only changed bodies
 
-    content_type = res.headers["Content-Type"]
-    m = re.search('boundary="(.*?)"', content_type, re.I)
-    assert m
-    boundary = b"\r\n--" + bytes(m[1], "ascii")
+    Returns a bytearray, create_response passes it on to WSGI in bytes slices.
+    """
 
-    payload: List[bytes] = []
-    for part in res.content.split(boundary):
-        content_id = get_content_id(part)
-        if (
-            content_id in virus_atts
-            or content_id == "root.message"
-            and REMOVE_MALICIOUS
-        ):
-            att = cast(
-                EmailMessage,
-                next(
-                    (
-                        a
-                        for a in msg.iter_parts()
-                        if content_id == extract_id(a.get("Content-ID", ""))
-                    ),
-                    None,
-                ),
-            )
-            if att:
-                content = att.get_content()
-                payload.append(part.split(b"\r\n\r\n")[0] + b"\r\n\r\n" + content)
-            else:
-                logging.error(
-                    f"Content-ID not present: {content_id} in {next(msg.iter_parts()).items()}"
-                )
+    # written into one growing buffer, no list of parts plus joined copy
+    payload = bytearray()
+    for part in parts:
+        body = bodies.get(part.content_id, part.body)
+        if body is None:
+            # removed document, together with the delimiter in front of it
+            continue
 
+        if body is part.body:
+            payload += part.raw
         else:
-            payload.append(part)
-
-    return boundary.join(payload)
-
+            payload += part.raw[: len(part.raw) - len(part.body)]
+            payload += body
 
-def get_content_id(content: bytes):
-    m = re.search(b"\r\nContent-ID: (.*?)\r\n", content, re.I)
-    if m:
-        return extract_id(m[1].decode("ascii"))
+    return payload
 
 
-# create dictonary with mimetypes: filename
+# create dictonary with mimetypes: content, files are read once at startup
 replacement_files = {
-    os.path.splitext(dir_entry.name)[0].replace("_", "/"): dir_entry.path
+    os.path.splitext(dir_entry.name)[0].replace("_", "/"): Path(
+        dir_entry.path
+    ).read_bytes()
     for dir_entry in os.scandir("replacements")
 }
 
 
 def get_replacement(mimetype):
     """get content for replacements"""
-    filename = replacement_files.get(mimetype) or replacement_files.get("text/plain")
-    with open(filename, "rb") as f:
-        return f.read()
+    return replacement_files.get(mimetype) or replacement_files["text/plain"]
 
 
 def dump(dict):
@@ -540,6 +900,17 @@ def dump(dict):
 
 # File Scanning
 
+@dataclass(frozen=True)
+class IcapConfig:
+    """ICAP settings, read once instead of per scan"""
+
+    host: str
+    port: int
+    service: str
+    ssl_context: Optional[ssl.SSLContext]
+    timeout: float
+
+
 def get_file_scanner():
     clamd_path = config["config"].get("clamd_socket")
     icap_host = config["config"].get("icap_host")
@@ -551,48 +922,74 @@ def get_file_scanner():
     
     if clamd_path:
         # CLAMAV
-        import clamd  # type: ignore
-        global clamav_sock
-        clamav_sock = clamd.ClamdUnixSocket(
-            path=config["config"]["clamd_socket"])
+        global clamav_path
+        clamav_path = clamd_path
         return scan_file_clamav
     else:
         # ICAP
+        global icap_config
+        icap_config = IcapConfig(
+            host=icap_host,
+            port=config["config"].getint("icap_port", 1344),
+            service=config["config"]["icap_service"],
+            # loading the CA bundle is expensive, so do it once
+            ssl_context=ssl.create_default_context()
+            if config["config"].getboolean("icap_tls", False)
+            else None,
+            timeout=config["config"].getfloat("icap_timeout", 60),
+        )
         return scan_file_icap
 
 def scan_file_clamav(content):
-    "return scan result, do use clamav socket"
-    scan_res = clamav_sock.instream(io.BytesIO(content))["stream"]
-    return scan_res
+    """return scan result, do use clamav socket
+
+    INSTREAM is sent here instead of clamd.instream, which copies the content
+    into 1 KiB chunks and sends each with its own syscall.
+    """
+    view = memoryview(content)
+    rcv = bytearray()
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(clamav_path)
+        sock.sendall(b"zINSTREAM\0")
+        # chunks must stay below StreamMaxLength of clamd.conf
+        for pos in range(0, len(view), CHUNK_SIZE):
+            chunk = view[pos : pos + CHUNK_SIZE]
+            _send_buffers(sock, [struct.pack("!L", len(chunk)), chunk])
+        sock.sendall(struct.pack("!L", 0))
+
+        while not rcv.endswith(b"\0"):
+            data = sock.recv(4096)
+            if not data:
+                break
+            rcv += data
+
+    found = RE_CLAMD_RESULT.fullmatch(rcv.rstrip(b"\0"))
+    if not found:
+        raise EnvironmentError("clamd not OK", bytes(rcv))
+
+    reason = found[1].decode() if found[1] else None
+    return [found[2].decode(), reason]
     
 def scan_file_icap(content):
     "return scan result, do use icap"                
-    icap_service = config["config"]["icap_service"]
-    icap_host = config["config"]["icap_host"]
-    icap_port = config["config"].getint("icap_port", 1344)
-    icap_tls = config["config"].getboolean("icap_tls", False)
-
-    req = f"RESPMOD {icap_service} ICAP/1.0\r\n"
-    req += f"Host: {icap_host}\r\n"
+    req = f"RESPMOD {icap_config.service} ICAP/1.0\r\n"
+    req += f"Host: {icap_config.host}\r\n"
     req += f"Encapsulated: res-body=0\r\n\r\n"
     req += f"{len(content):x}\r\n"
 
     footer = "\r\n0\r\n\r\n"
 
-    rcv_chunks = []
+    with _open_sock(
+        icap_config.host,
+        icap_config.port,
+        icap_config.ssl_context,
+        icap_config.timeout,
+    ) as sock:
+        _send_buffers(sock, [req.encode(), content, footer.encode()])
+        rcv = _recv_icap_response(sock)
 
-    with _open_sock(icap_host, icap_port, icap_tls) as sock:
-        sock.send(req.encode())
-        sock.send(content)
-        sock.send(footer.encode())
-    
-        while True:
-            data = sock.recv(4096)
-            rcv_chunks.append(data)
-            if (not len(data) or data[-5:] == b"0\r\n\r\n"):
-                break
-
-    rsp = b''.join(rcv_chunks)[:2048]
+    rsp = bytes(rcv[:2048])
 
     (first_block, second_block) = rsp.split(b"\r\n\r\n", 1)
     first_line = first_block.partition(b'\r\n')[0]
@@ -601,7 +998,7 @@ def scan_file_icap(content):
     logging.debug(second_block[:500])
 
     # check icap status
-    if first_line == b"ICAP/1.0 204 No modifications needed":
+    if first_line.startswith(b"ICAP/1.0 204"):
         return ["OK", None]
 
     if first_line != b"ICAP/1.0 200 OK":
@@ -612,7 +1009,7 @@ def scan_file_icap(content):
         return ["OK", None]
 
     # gather additional information    
-    found = re.search(b"X-Infection-Found: .*Threat=(.*);", first_block)    
+    found = RE_ICAP_INFECTION.search(first_block)    
     
     if found:
         return ["FOUND", found[1]]
@@ -620,14 +1017,64 @@ def scan_file_icap(content):
     return ["FOUND", "unknown"]
 
 
-def _open_sock(host, port, tls):
+def _send_buffers(sock, buffers):
+    """Send buffers with vectored writes, without joining them into one copy"""
+    if isinstance(sock, ssl.SSLSocket):
+        # sendmsg is not supported for TLS
+        sock.sendall(b"".join(buffers))
+        return
+
+    views = [memoryview(buffer) for buffer in buffers]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if sent:
+            views[0] = views[0][sent:]
+
+
+def _recv_icap_response(sock) -> bytearray:
+    """Receive ICAP response, the server may keep the connection open after it"""
+    rcv = bytearray()
+    header_end = -1
+
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            break
+        rcv += data
+
+        # header block and terminating chunk may be split over several recv calls
+        if header_end < 0:
+            header_end = rcv.find(b"\r\n\r\n")
+            if header_end < 0:
+                continue
+        header = rcv[:header_end]
+
+        if header.startswith(b"ICAP/1.0 204"):
+            break
+        null_body = RE_ICAP_NULL_BODY.search(header)
+        if null_body:
+            # only encapsulated http headers follow, no chunked body
+            if len(rcv) >= header_end + 4 + int(null_body[1]):
+                break
+        elif rcv.endswith(b"\r\n0\r\n\r\n"):
+            break
+
+    return rcv
+
+
+def _open_sock(host, port, context, timeout):
+
+    sock = socket.create_connection((host, port), timeout=timeout)
+    # do not let Nagle hold back the small request parts
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-    if tls:
-        with socket.create_connection((host, port)) as sock:
-            context = ssl.create_default_context()
+    if context:
+        with sock:
             return context.wrap_socket(sock, server_hostname=host)
     else:
-        return socket.create_connection((host, port))
+        return sock
 
 
 scan_file = get_file_scanner()
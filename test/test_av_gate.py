@@ -1,13 +1,16 @@
 import configparser
+import http.server
 import io
 import re
+import socket
+import threading
 import xml.etree.ElementTree as ET
 from unittest import mock
 from unittest.mock import Mock
 
-import clamd  # type: ignore
 import pytest
 import requests
+from werkzeug.test import EnvironBuilder, run_wsgi_app
 
 import av_gate
 
@@ -28,12 +31,14 @@ av_gate.config.read_dict(
         },
     }
 )
+av_gate.CLIENTS = av_gate.load_clients()
 av_gate.scan_file = av_gate.get_file_scanner()
 
 
 @pytest.fixture
 def client(monkeypatch):
     av_gate.config.update({"*:400": {"Konnektor": "https://nowhere.com"}})
+    av_gate.CLIENTS = av_gate.load_clients()
     with av_gate.app.test_client() as client:
         with av_gate.app.app_context():
 
@@ -61,6 +66,9 @@ def client(monkeypatch):
                 def __exit__(self, exc_type, exc_val, exc_tb):
                     pass
 
+                def iter_content(self, chunk_size=1):
+                    yield self.content
+
             def mock_request(url: str, data: bytes, *args, **kwargs):
 
                 if url.endswith("connector.sds"):
@@ -116,23 +124,28 @@ def client(monkeypatch):
 
                 return MockResponse()
 
-            monkeypatch.setattr(requests, "request", mock_request)
+            monkeypatch.setattr(
+                requests.Session,
+                "request",
+                lambda session, *args, **kwargs: mock_request(*args, **kwargs),
+            )
 
             yield client
 
 
 @pytest.fixture
 def clamav(monkeypatch):
-    # Mock clamd
-    def instream(stream: io.BytesIO):
-        if b"EICAR" in stream.read():
-            return {"stream": ("FOUND", "Win.Test.EICAR_HDB-1")}
+    # Mock virus scanner, clamd and icap are tested separately
+    def scan_file(content):
+        if b"EICAR" in bytes(content):
+            return ["FOUND", "Win.Test.EICAR_HDB-1"]
         else:
-            return {"stream": ("OK", None)}
-    mock_instream = Mock(side_effect=instream)
-    monkeypatch.setattr(clamd, "ClamdUnixSocket", Mock(return_value=mock_instream))
+            return ["OK", None]
+
+    mock_scan_file = Mock(side_effect=scan_file)
+    monkeypatch.setattr(av_gate, "scan_file", mock_scan_file)
 
-    yield mock_instream
+    yield mock_scan_file
 
 
 @pytest.mark.parametrize(
@@ -196,6 +209,26 @@ def test_connector_sds(client):
     )
 
 
+@pytest.mark.parametrize("host", ['x"/><evil a="b:400', "a&b'c:400", "k\xf6nnektor:400"])
+def test_connector_sds_hostile_host(client, host):
+    "host is escaped when written into the raw connector.sds"
+
+    res = client.get(
+        "/connector.sds",
+        headers={"X-real-ip": "9.9.9.9", "Host": host},
+    )
+    xml = ET.fromstring(res.data)
+
+    assert res.status_code == 200
+    assert xml.find(".//evil") is None
+    assert (
+        xml.find(
+            "{*}ServiceInformation/{*}Service[@Name='PHRService']/{*}Versions/{*}Version[@Version='1.3.0']/{*}EndpointTLS"
+        ).attrib["Location"]
+        == f"https://{host}/soap-api/PHRService/1.3.0"
+    )
+
+
 def test_proxy_all_service(client):
     "check all endpoints are replaced"
 
@@ -226,7 +259,7 @@ def test_clam_av(client, clamav):
     xml = ET.fromstring(parts[1][re.search(b"(\r\n){2}", parts[1]).end() :])
 
     assert len(parts) == 6  # n+2
-    assert clamav.has_been_called()
+    assert clamav.called
 
 
 def test_virus_removed(client, clamav):
@@ -254,7 +287,7 @@ def test_virus_removed(client, clamav):
     xml = ET.fromstring(parts[1][re.search(b"(\r\n){2}?", parts[1]).end() :])
 
     assert len(parts) == 5  # n+2
-    assert clamav.has_been_called()
+    assert clamav.called
     rres = xml.find("*//{*}RetrieveDocumentSetResponse/{*}RegistryResponse")
     assert (
         rres is not None
@@ -291,7 +324,7 @@ def test_virus_replaced(client, clamav):
     xml = ET.fromstring(parts[1].split(b"\r\n\r\n")[1])
 
     assert len(parts) == 6  # n+2
-    assert clamav.has_been_called()
+    assert clamav.called
     rres = xml.find("*//{*}RetrieveDocumentSetResponse/{*}RegistryResponse")
     assert (
         rres is not None
@@ -327,7 +360,7 @@ def test_virus_replaced_mimetype(client, clamav):
     xml = ET.fromstring(parts[1].split(b"\r\n\r\n")[1])
 
     assert len(parts) == 6  # n+2
-    assert clamav.has_been_called()
+    assert clamav.called
     rres = xml.find("*//{*}RetrieveDocumentSetResponse/{*}RegistryResponse")
     assert (
         rres is not None
@@ -439,6 +472,35 @@ Content-ID: <root.message@cxf.apache.org>
     assert res.status_code == 200
 
 
+def test_modified_body_is_bytes(client, clamav):
+    "WSGI servers only accept bytes, also for bodies built in a bytearray"
+    av_gate.REMOVE_MALICIOUS = False
+
+    data = (
+        open("./test/retrieveDocumentSet_req.xml", "rb")
+        .read()
+        .replace(b"\n", b"\r\n")
+        .replace(
+            b"<DocumentUniqueId>2.25.140094387439901233557</DocumentUniqueId>",
+            b"<DocumentUniqueId>GET_EICAR</DocumentUniqueId>",
+        )
+    )
+    environ = EnvironBuilder(
+        path="/soap-api/PHRService/1.3.0",
+        method="POST",
+        headers={"X-real-ip": "9.9.9.9", "Host": "7.7.7.7:400"},
+        data=data,
+    ).get_environ()
+
+    app_iter, status, headers = run_wsgi_app(av_gate.app, environ)
+    chunks = list(app_iter)
+
+    assert status.startswith("200")
+    assert chunks and all(type(chunk) is bytes for chunk in chunks)
+    assert int(headers["Content-Length"]) == sum(len(chunk) for chunk in chunks)
+    assert b"potentiell schadhafter Code" in b"".join(chunks)
+
+
 def test_int_clam_av(client):
     "check virus is removed with real clamd"
 
@@ -546,3 +608,353 @@ def test_int_icap(client):
 )
 def test_extract_id(in_id, out_id):
     assert av_gate.extract_id(in_id) == out_id
+
+
+def test_ssl_verify_default(client):
+    "sections without ssl_verify keep certificate verification on"
+    client_config = av_gate.CLIENTS["*:400"]
+
+    assert client_config.verify is True
+
+
+def test_ssl_settings_per_request(client, monkeypatch):
+    "verify and cert are passed per request, env CA bundles must not override them"
+    calls = []
+    monkeypatch.setattr(
+        requests.Session,
+        "request",
+        lambda session, *args, **kwargs: calls.append(kwargs),
+    )
+    client_config = av_gate.ClientConfig(
+        name="ssl-test",
+        konnektor="https://nowhere.com",
+        konnektor_bytes=b"https://nowhere.com",
+        cert=("client.crt", "client.key"),
+        verify=False,
+        proxy_all_services=False,
+    )
+
+    with av_gate.app.test_request_context(
+        "/soap-api/other", headers={"X-real-ip": "9.9.9.9"}
+    ):
+        av_gate.request_upstream(client_config)
+
+    assert calls[0]["verify"] is False
+    assert calls[0]["cert"] == ("client.crt", "client.key")
+
+
+def test_session_keeps_no_cookies():
+    "pooled sessions are shared by all clients of a konnektor"
+    received = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            received.append(self.headers.get("Cookie"))
+            self.send_response(200)
+            self.send_header("Set-Cookie", "SESSION=clientA; Path=/")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        konnektor = f"http://127.0.0.1:{server.server_port}"
+        session = av_gate.get_session(
+            av_gate.ClientConfig(
+                name="cookie-test",
+                konnektor=konnektor,
+                konnektor_bytes=konnektor.encode(),
+                cert=None,
+                verify=True,
+                proxy_all_services=False,
+            )
+        )
+        session.get(konnektor + "/first")
+        session.get(konnektor + "/second")
+    finally:
+        server.shutdown()
+        thread.join()
+
+    assert received == [None, None]
+    assert not session.cookies
+
+
+@pytest.mark.parametrize(
+    "response",
+    [
+        b"ICAP/1.0 204 No modifications needed\r\nEncapsulated: null-body=0\r\n\r\n",
+        b"ICAP/1.0 200 OK\r\nEncapsulated: res-hdr=0, null-body=19\r\n\r\n"
+        b"HTTP/1.0 200 OK\r\n\r\n",
+        b"ICAP/1.0 200 OK\r\nEncapsulated: res-hdr=0, res-body=19\r\n\r\n"
+        b"HTTP/1.0 403 Forb\r\n\r\n5\r\nvirus\r\n0\r\n\r\n",
+    ],
+)
+def test_icap_response_keep_alive(response):
+    "ICAP response is complete without the server closing the connection"
+    server, client = socket.socketpair()
+    with server, client:
+        client.settimeout(2)
+        server.sendall(response[:10])
+        server.sendall(response[10:])
+
+        assert av_gate._recv_icap_response(client) == response
+
+
+def test_parse_documents_inline():
+    "inline documents without xop:Include are no attachments and are skipped"
+    soap = b"""<s:Envelope xmlns:s="http://www.w3.org/2003/05/soap-envelope"
+        xmlns:x="urn:ihe:iti:xds-b:2007" xmlns:xop="http://www.w3.org/2004/08/xop/include">
+    <s:Body><x:RetrieveDocumentSetResponse>
+        <x:DocumentResponse>
+            <x:DocumentUniqueId>1.2.3</x:DocumentUniqueId>
+            <x:mimeType>application/pdf</x:mimeType>
+            <x:Document><xop:Include href="cid:abc%40cxf.apache.org"/></x:Document>
+        </x:DocumentResponse>
+        <x:DocumentResponse>
+            <x:DocumentUniqueId>4.5.6</x:DocumentUniqueId>
+            <x:mimeType>text/plain</x:mimeType>
+            <x:Document>aW5saW5l</x:Document>
+        </x:DocumentResponse>
+    </x:RetrieveDocumentSetResponse></s:Body></s:Envelope>"""
+
+    assert av_gate.parse_documents(soap) == {"abc": ("1.2.3", "application/pdf")}
+
+
+def test_konnektor_reset_while_reading(client, monkeypatch):
+    "broken off response body is answered with bad gateway"
+
+    class BrokenResponse:
+        headers = {"Content-Type": "text/xml"}
+        status_code = 200
+
+        def iter_content(self, chunk_size=1):
+            yield b"<partial"
+            raise requests.exceptions.ChunkedEncodingError("connection reset")
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc_val, exc_tb):
+            pass
+
+    monkeypatch.setattr(
+        requests.Session, "request", lambda session, *args, **kwargs: BrokenResponse()
+    )
+
+    res = client.post(
+        "/soap-api/PHRService/1.3.0",
+        headers={"X-real-ip": "9.9.9.9", "Host": "7.7.7.7:400"},
+        data=b"RetrieveDocumentSet",
+    )
+
+    assert res.status_code == 502
+
+
+@pytest.mark.parametrize(
+    "reply,expected",
+    [
+        (b"stream: OK\0", ["OK", None]),
+        (b"stream: Eicar-Test-Signature FOUND\0", ["FOUND", "Eicar-Test-Signature"]),
+        (b"stream: Can't allocate memory ERROR\0", ["ERROR", "Can't allocate memory"]),
+    ],
+)
+def test_scan_file_clamav(tmp_path, monkeypatch, reply, expected):
+    "INSTREAM is sent in sized chunks with zero terminator, reply is parsed"
+    path = str(tmp_path / "clamd.socket")
+    monkeypatch.setattr(av_gate, "clamav_path", path, raising=False)
+    content = b"x" * (av_gate.CHUNK_SIZE * 2 + 5)
+    received = {}
+
+    def clamd_server(server):
+        conn, _ = server.accept()
+        with conn, conn.makefile("rb") as stream:
+            received["command"] = stream.read(10)
+            received["sizes"] = sizes = []
+            received["data"] = b""
+            while True:
+                sizes.append(int.from_bytes(stream.read(4), "big"))
+                if not sizes[-1]:
+                    break
+                received["data"] += stream.read(sizes[-1])
+            conn.sendall(reply)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(path)
+        server.listen()
+        thread = threading.Thread(target=clamd_server, args=(server,))
+        thread.start()
+        result = av_gate.scan_file_clamav(memoryview(content))
+        thread.join(2)
+
+    assert result == expected
+    assert received["command"] == b"zINSTREAM\0"
+    assert received["sizes"] == [av_gate.CHUNK_SIZE, av_gate.CHUNK_SIZE, 5, 0]
+    assert received["data"] == content
+
+
+def test_scan_file_clamav_error(tmp_path, monkeypatch):
+    "clamd replies without stream result raise"
+    path = str(tmp_path / "clamd.socket")
+    monkeypatch.setattr(av_gate, "clamav_path", path, raising=False)
+
+    def clamd_server(server):
+        conn, _ = server.accept()
+        with conn:
+            conn.recv(1024)
+            conn.sendall(b"INSTREAM size limit exceeded. ERROR\0")
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(path)
+        server.listen()
+        thread = threading.Thread(target=clamd_server, args=(server,))
+        thread.start()
+        with pytest.raises(EnvironmentError):
+            av_gate.scan_file_clamav(b"x")
+        thread.join(2)
+
+
+BOUNDARY = b"\r\n--uuid:999"
+MULTIPART = (
+    b"--uuid:999\r\n"
+    b"Content-Type: application/xop+xml\r\n"
+    b"Content-ID: <root.message@cxf.apache.org>\r\n\r\n"
+    b"<soap/>"
+    b"\r\n--uuid:999\r\n"
+    b"Content-Type: application/pdf\r\n"
+    b"Content-ID: <1-doc@cxf.apache.org>\r\n\r\n"
+    b"%PDF-1"
+    b"\r\n--uuid:999\r\n"
+    b"Content-Type: text/plain\r\n"
+    b"Content-Transfer-Encoding: base64\r\n"
+    b"Content-ID: <2-doc@cxf.apache.org>\r\n\r\n"
+    b"dGV4dA==\r\n"
+    b"\r\n--uuid:999--\r\n"
+)
+
+
+@pytest.mark.parametrize("content", [MULTIPART, b"preamble\r\n" + MULTIPART])
+def test_mime_parts_round_trip(content):
+    "split parts give content again, also without CRLF in front of first delimiter"
+    parts = list(av_gate.iter_mime_parts(content, BOUNDARY))
+    soap_part, *attachments = [part for part in parts if part.headers]
+
+    assert bytes(av_gate.build_payload(parts, {})) == content
+    assert soap_part.headers == {
+        "content-type": "application/xop+xml",
+        "content-id": "<root.message@cxf.apache.org>",
+    }
+    assert bytes(soap_part.body) == b"<soap/>"
+    assert [att.content_id for att in attachments] == ["1-doc", "2-doc"]
+    assert bytes(av_gate.get_content(attachments[1])) == b"text"
+
+
+def test_build_payload_changed_parts():
+    "removed parts go with their delimiter, replaced bodies keep their headers"
+    parts = list(av_gate.iter_mime_parts(MULTIPART, BOUNDARY))
+
+    payload = av_gate.build_payload(
+        parts, {"root.message": b"<new/>", "1-doc": None, "2-doc": b"bmV3\r\n"}
+    )
+
+    assert bytes(payload) == (
+        b"--uuid:999\r\n"
+        b"Content-Type: application/xop+xml\r\n"
+        b"Content-ID: <root.message@cxf.apache.org>\r\n\r\n"
+        b"<new/>"
+        b"\r\n--uuid:999\r\n"
+        b"Content-Type: text/plain\r\n"
+        b"Content-Transfer-Encoding: base64\r\n"
+        b"Content-ID: <2-doc@cxf.apache.org>\r\n\r\n"
+        b"bmV3\r\n"
+        b"\r\n--uuid:999--\r\n"
+    )
+
+
+def test_request_body_content_length():
+    "streamed request body is sent with Content-Length, not chunked"
+    body = av_gate.RequestBody(io.BytesIO(b"x" * 100000), 100000)
+
+    prepared = requests.Request("POST", "http://konnektor/", data=body).prepare()
+
+    assert prepared.headers["Content-Length"] == "100000"
+    assert "Transfer-Encoding" not in prepared.headers
+    assert b"".join(body) == b"x" * 100000
+
+
+def test_send_buffers_partial():
+    "partly sent buffers are resumed where sendmsg stopped"
+
+    class SlowSocket:
+        sent = b""
+
+        def sendmsg(self, buffers):
+            # at most 3 bytes per call, across buffer borders
+            data = b"".join(bytes(buffer) for buffer in buffers)[:3]
+            self.sent += data
+            return len(data)
+
+    sock = SlowSocket()
+    av_gate._send_buffers(sock, [b"head", b"", memoryview(b"content"), b"0\r\n"])
+
+    assert sock.sent == b"headcontent0\r\n"
+
+
+def test_hop_by_hop_headers(client, monkeypatch):
+    "hop-by-hop headers of the client are not forwarded on pooled connections"
+    calls = []
+    monkeypatch.setattr(
+        requests.Session,
+        "request",
+        lambda session, *args, **kwargs: calls.append(kwargs),
+    )
+
+    with av_gate.app.test_request_context(
+        "/soap-api/other",
+        method="POST",
+        data=b"abc",
+        headers={
+            "X-real-ip": "9.9.9.9",
+            "Connection": "keep-alive, X-Client-Hop",
+            "X-Client-Hop": "1",
+            "Transfer-Encoding": "chunked",
+            "TE": "trailers",
+            "Trailer": "Expires",
+            "Upgrade": "h2c",
+            "Proxy-Connection": "keep-alive",
+            "SOAPAction": "retrieve",
+        },
+    ):
+        av_gate.request_upstream(av_gate.CLIENTS["*:400"])
+
+    forwarded = {key.lower() for key in calls[0]["headers"]}
+    assert "soapaction" in forwarded
+    assert not forwarded & {
+        "connection",
+        "x-client-hop",
+        "transfer-encoding",
+        "te",
+        "trailer",
+        "upgrade",
+        "proxy-connection",
+    }
+
+
+def test_get_content_quoted_printable():
+    "quoted-printable parts reach the scanner decoded"
+    parts = list(
+        av_gate.iter_mime_parts(
+            b"--uuid:999\r\n"
+            b"Content-Transfer-Encoding: quoted-printable\r\n"
+            b"Content-ID: <1-doc@cxf.apache.org>\r\n\r\n"
+            b"X5O!P%@AP[4\\PZX54(P^)7CC)7}$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!$H=\r\n"
+            b"+H=2A"
+            b"\r\n--uuid:999--\r\n",
+            BOUNDARY,
+        )
+    )
+
+    assert av_gate.EICAR in bytes(av_gate.get_content(parts[0]))